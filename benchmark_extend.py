@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+'''Time the code generated for .extend(x) on large arrays, in node.
+
+Converts a Python function calling .extend(x) with each --extend mode
+(spread: .push(...x), and helper: the _extend helper), compiles the
+results with coffee, and times them on arrays and Sets of increasing sizes.
+Requires coffee (CoffeeScript 2) and node.
+'''
+import argparse, json, shutil, subprocess, sys
+import python2coffee
+
+## Python code whose conversion gets timed, once per --extend mode
+source = '''\
+def %s(array, items):
+  array.extend(items)
+'''
+
+benchmark_js = '''\
+var sizes = %s;
+function time(name, size, make, f) {
+  var items = make(size), array = [];
+  var start = process.hrtime.bigint();
+  try {
+    f(array, items);
+  } catch (e) {
+    return console.log(name, size, e.name);
+  }
+  var ms = Number(process.hrtime.bigint() - start) / 1e6;
+  if (array.length !== size) return console.log(name, size, 'wrong length');
+  console.log(name, size, ms.toFixed(1) + 'ms');
+}
+function makeArray(n) { return Array.from({length: n}, (_, i) => i); }
+function makeSet(n) { return new Set(makeArray(n)); }
+for (var size of sizes) {
+  time('spread array', size, makeArray, spread);
+  time('helper array', size, makeArray, helper);
+  time('helper set', size, makeSet, helper);
+}
+'''
+
+def generated_coffee():
+  ## CoffeeScript defining spread and helper, converted from source
+  return ''.join(python2coffee.convert_code(source % extend,
+    conversion=python2coffee.Conversion(extend=extend))
+    for extend in ['spread', 'helper'])
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('sizes', metavar='N', type=int, nargs='*',
+    default=[10**4, 10**5, 10**6, 10**7], help='array sizes to time')
+  parser.add_argument('--print', action='store_true',
+    help='print the generated CoffeeScript instead of running it')
+  args = parser.parse_args()
+  coffee = generated_coffee()
+  if args.print:
+    print(coffee, end='')
+    return
+  for program in ['coffee', 'node']:
+    if shutil.which(program) is None:
+      sys.exit('%s not found; install it (e.g. npm install -g coffeescript)'
+        % program)
+  js = subprocess.run(['coffee', '--bare', '--compile', '--stdio'],
+    input=coffee, capture_output=True, text=True, check=True).stdout
+  subprocess.run(['node', '-e', js + benchmark_js % json.dumps(args.sizes)],
+    check=True)
+
+if __name__ == '__main__': main()
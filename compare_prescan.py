@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+'''Check that the prescan doesn't change the converted output.
+
+Converts each file (and a few ranges within it) twice: with the prescan
+that skips rules whose names don't occur in the code, and without it
+(trying every rule), and reports any conversions whose CoffeeScript or
+diagnostics differ.  Exits with status 1 if there are any.
+'''
+import argparse, glob, os, sys, sysconfig, time
+import python2coffee
+
+def convert(tree, prescan, start = None, end = None):
+  conversion = python2coffee.Conversion(prescan=prescan)
+  try:
+    if start is None:
+      coffee = python2coffee.convert_tree(tree, conversion)
+    else:
+      coffee = python2coffee.convert_range(tree, start, end, conversion)
+  except Exception as e:
+    coffee = 'Exception: %r' % e
+  return coffee, conversion.diagnostics
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('filenames', metavar='filename.py', nargs='*',
+    help='Python files to convert (default: the standard library modules)')
+  parser.add_argument('-r', '--ranges', type=int, default=8,
+    help='number of ranges to convert per file (default: 8)')
+  parser.add_argument('-p', '--python', metavar='N.N',
+    dest='python_version', default='3.8', help='Python version (e.g. 3.8)')
+  args = parser.parse_args()
+  filenames = args.filenames or \
+    sorted(glob.glob(os.path.join(sysconfig.get_paths()['stdlib'], '*.py')))
+  sys.setrecursionlimit(20000)  # for deeply nested code
+
+  conversions = mismatches = 0
+  times = {True: 0, False: 0}
+  for filename in filenames:
+    with open(filename, encoding='utf8') as file:
+      code = file.read()
+    lines = code.count('\n') + 1
+    ranges = [(None, None)] + [((line, 0), (line, 0))
+      for line in range(1, lines + 1, max(1, lines // args.ranges))]
+    for start, end in ranges:
+      results = {}
+      for prescan in [True, False]:
+        tree = python2coffee.parse_parso(code, args.python_version)
+        began = time.time()
+        results[prescan] = convert(tree, prescan, start, end)
+        times[prescan] += time.time() - began
+      conversions += 1
+      if results[True] != results[False]:
+        mismatches += 1
+        if start is None:
+          print('MISMATCH: %s' % filename)
+        else:
+          print('MISMATCH: %s -r %d:%d-%d:%d' % ((filename,) + start + end))
+  print('%d conversions: %.1fs with prescan, '
+    '%.1fs without' % (conversions, times[True], times[False]))
+  print('%d mismatches' % mismatches)
+  sys.exit(1 if mismatches else 0)
+
+if __name__ == '__main__': main()
@@ -1,6 +1,12 @@
 #!/usr/bin/python3
-import argparse, os, re, warnings
-import parso, parso.python.tree
+import argparse, ast, concurrent.futures, contextlib, contextvars, io
+import multiprocessing, multiprocessing.connection, os, re, sys, time
+import tokenize, warnings
+try:
+  import resource
+except ImportError:  # not on Windows
+  resource = None
+import parso, parso.cache, parso.python.parser, parso.python.tree, parso.utils
 
 def is_node(node, type):
   return node.type == type
@@ -33,6 +39,9 @@ def set_children_parents(node):
   for child in node.children:
     child.parent = node
 
+def is_empty_call_trailer(node):
+  return node.type == 'trailer' and len(node.children) == 2 and \
+    is_operator(node.children[0], '(') and is_operator(node.children[1], ')')
 def is_call_trailer(node):
   return node.type == 'trailer' and \
     is_operator(node.children[0], '(') and \
@@ -59,6 +68,19 @@ def split_call_trailer(node):
   else:
     assert len(node.children) == 3
     return [node.children[1]]
+def call_args(node, function):
+  ## Returns the arguments if node is a call function(...) without
+  ## keyword arguments or *args, or None otherwise.
+  if node.type in ['atom_expr', 'power'] and len(node.children) == 2 and \
+     is_name(node.children[0], function) and \
+     is_empty_call_trailer(node.children[1]):
+    return []
+  elif node.type in ['atom_expr', 'power'] and len(node.children) == 2 and \
+     is_name(node.children[0], function) and \
+     is_call_trailer(node.children[1]):
+    args = split_call_trailer(node.children[1])
+    if not any(is_node(arg, 'argument') for arg in args):
+      return args
 def replace_arg_in_call_trailer(node, index, new = None):
   force_call_trailer_arglist(node)
   args = node.children[1]
@@ -81,7 +103,7 @@ def replace_arg_in_call_trailer(node, index, new = None):
 # ensure not keyword argument, *args, **dargs
 def assert_simple_arg(arg, function):
   if is_node(arg, 'argument'):
-    warnings.warn('Unrecognized argument to %s: %s' %
+    warn('Unrecognized argument to %s: %s' %
       (function, arg))
 def assert_simple_args(args, function):
   for arg in args:
@@ -113,9 +135,9 @@ def fix_call_trailer(node):
     if is_operator(arg, '*'):
       arg.value = '...'
     elif is_operator(arg, '**'):
-      warnings.warn('No analog to f(**dargs) in CoffeeScript')
+      warn('No analog to f(**dargs) in CoffeeScript')
     elif is_operator(arg, '='):
-      warnings.warn('No support yet for f(key=value)')
+      warn('No support yet for f(key=value)')
 def fix_parameters(node):
   assert is_node(node, 'parameters')
   assert is_operator(node.children[0], '(')
@@ -126,7 +148,7 @@ def fix_parameters(node):
       if is_operator(arg, '*'):
         arg.value = '...'
       elif is_operator(arg, '**'):
-        warnings.warn('No analog to def(**dargs) in CoffeeScript')
+        warn('No analog to def(**dargs) in CoffeeScript')
 
 # Compare https://docs.python.org/3/reference/lexical_analysis.html#literals
 # to https://developer.mozilla.org/en-US/docs/Web/JavaScript/Guide/Grammar_and_types#Using_special_characters_in_strings
@@ -230,32 +252,81 @@ re_flags_map = {
   'MULTILINE': 'm', 'M': 'm',
   'DOTALL': 's', 'S': 's'
 }
-def string_to_regexp(node, flags):
+def regexp_flags(flags):
+  ## Flag letters for re.X | re.Y | ... flags, or None if unrecognized
+  if flags.type in ['expr', 'arith_expr'] and \
+     all(is_operator(op, '|') for op in flags.children[1::2]):
+    letters = [regexp_flags(flag) for flag in flags.children[::2]]
+    if None not in letters:
+      return ''.join(letters)
+  elif flags.type in ['atom_expr', 'power'] and len(flags.children) == 2 and \
+       is_name(flags.children[0], 're') and \
+       is_method_trailer(flags.children[1]):
+    flag = flags.children[1].children[1].value
+    if flag in re_flags_map:
+      return re_flags_map[flag]
+    elif flag in ['VERBOSE', 'X']:
+      return 'x'
+    else:
+      warn('Regexp flag unsupported in CoffeeScript: %s' % flag)
+      return ''
+  return None
+def string_to_regexp(node, flags, extra_flags = '', anchor = None):
+  ## Regexp for the pattern in string node, with optional Python flags node
+  ## and extra CoffeeScript flag letters.  anchor 'start' or 'both' anchors
+  ## the pattern at the start (and end) of the string, as in re.match (and
+  ## re.fullmatch).  Patterns that must be compiled at run time get hoisted
+  ## into module-level constants (see hoist_regexp).
   assert is_string(node)
   regexp_backrefs(node)
   string = parse_string(node)
-  if 'r' in string['flags']:
-    string['content'] = re.sub(r'(\\*)/', escape_unescaped, string['content'])
-    regexp = '/' + string['content'] + '/'
-  else:
-    regexp = 'new RegExp(' + string['quote'] + string['content'] + string['quote'] + ')'
+  letters = ''
   if flags:
-    # xxx handle multiple flags
-    if flags.type in ['atom_expr', 'power'] and len(flags.children) == 2 and \
-       is_name(flags.children[0], 're') and \
-       is_method_trailer(flags.children[1]):
-      flag = flags.children[1].children[1].value
-      if flag in re_flags_map:
-        regexp += re_flags_map[flag]
-      elif flag in ['VERBOSE', 'X']:
-        regexp = '//' + regexp + '//'
-      else:
-        warnings.warn('Regexp flag unsupported in CoffeeScript: %s' % flag)
+    letters = regexp_flags(flags)
+    if letters is None:
+      warn('Unrecognized regexp flags: %s' % flags)
+      letters = ''
+  verbose = 'x' in letters
+  letters = letters.replace('x', '') + extra_flags
+  content = string['content']
+  if anchor:
+    if 'm' in letters:  # ^ and $ would match at line breaks too
+      before, after = r'(?<![\s\S])(?:', r')(?![\s\S])'
+    else:
+      before, after = '^(?:', ')$'
+    if anchor == 'start':
+      after = ')'
+    if 'r' not in string['flags']:
+      before = before.replace('\\', '\\\\')
+      after = after.replace('\\', '\\\\')
+    content = before + content + after
+  if 'r' in string['flags']:
+    content = re.sub(r'(\\*)/', escape_unescaped, content)
+    if verbose:
+      regexp = '///' + content + '///' + letters
     else:
-      warnings.warn('Unrecognized regexp flags: %s' % flags)
-  regexp = re.sub(r'^/ ', '/[ ]', regexp)
-  regexp = re.sub(r' /([a-z]*)$', r'[ ]/\1', regexp)
-  return CoffeeScript(regexp, '(')
+      regexp = '/' + content + '/' + letters
+      regexp = re.sub(r'^/ ', '/[ ]', regexp)
+      regexp = re.sub(r' /([a-z]*)$', r'[ ]/\1', regexp)
+    return CoffeeScript(regexp, '(')
+  if verbose:
+    warn('VERBOSE regexp flag requires a raw string')
+  regexp = 'new RegExp(' + string['quote'] + content + string['quote']
+  if letters:
+    regexp += ", '" + letters + "'"
+  regexp += ')'
+  return CoffeeScript(hoist_regexp(regexp), 'leaf')
+
+## Regexps compiled at run time (new RegExp) get computed once in
+## module-level constants instead of at every use.
+def hoist_regexp(regexp):
+  hoisted_regexps = current_conversion.get().hoisted_regexps
+  if hoisted_regexps is None:  # not hoisting
+    return regexp
+  if regexp not in hoisted_regexps:
+    hoisted_regexps[regexp] = '_regexp%d' % (len(hoisted_regexps) + 1)
+  return hoisted_regexps[regexp]
+
 def regexp_backrefs(node):
   assert is_string(node)
   node.value = re.sub(r'(?<!\\)(\\0|\\g<0>)', r'$&', node.value)
@@ -280,8 +351,9 @@ def terminate_comments(node):
     middle = re.sub(r'(?<!#)###(?!#)', '####', middle)
     s = split.group(1) + middle + split.group(3)
     return s
-  node.prefix = re.sub(r'^\s*###(?!#)(\s*).*$',
-    sub, node.prefix, re.MULTILINE)
+  if '###' in node.prefix:
+    node.prefix = re.sub(r'^\s*###(?!#)(\s*).*$',
+      sub, node.prefix, re.MULTILINE)
 
 def block_ends_with_return(block):
   ## Returns a list of "final" return_stmt's,
@@ -371,7 +443,7 @@ def top_op(root):
       elif isinstance(node, parso.python.tree.BaseNode):
         rest.extend(node.children)
     frontier = rest
-  warnings.warn('Could not determine top operator in %s' % node)
+  warn('Could not determine top operator in %s' % node)
   return 'lambda'
 
 def maybe_paren(node, op):
@@ -398,20 +470,23 @@ method_mapping = {
 }
 
 def leaf_iter(node):
-  first = node.get_first_leaf()
-  last = node.get_last_leaf()
-  leaf = first
-  yield leaf
-  while leaf is not last:
-    leaf = leaf.get_next_leaf()
-    yield leaf
+  ## Walk the tree directly: get_next_leaf is linear in the number of siblings
+  stack = [node]
+  while stack:
+    node = stack.pop()
+    if isinstance(node, parso.python.tree.BaseNode):
+      stack.extend(reversed(node.children))
+    else:
+      yield node
 
 def name_replace(node, match, repl):
-  for leaf in leaf_iter(node):
-    if is_name(leaf, match):
-      if hasattr(match, 'sub'):
+  if hasattr(match, 'sub'):
+    for leaf in leaf_iter(node):
+      if leaf.type == 'name' and match.search(leaf.value):
         leaf.value = match.sub(repl, leaf.value)
-      else:
+  else:
+    for leaf in leaf_iter(node):
+      if leaf.type == 'name' and leaf.value == match:
         leaf.value = repl
 
 def dump_tree(node, level = 0):
@@ -443,15 +518,60 @@ class CoffeeScript(parso.python.tree.Leaf):
                                                # start_pos meaningless
     self.outermost = outermost
 
+literal_node_types = {'atom', 'testlist_comp', 'dictorsetmaker', 'factor',
+  'strings'}
+literal_operators = {'[', ']', '(', ')', '{', '}', ',', ':', '-', '+'}
+def is_literal(node):
+  '''Whether node is made only of literals, brackets, and commas'''
+  if node.type == 'atom' and display_type(node) == 'set':
+    return False  # needs conversion to new Set
+  elif node.type in literal_node_types:
+    return all(map(is_literal, node.children))
+  elif node.type in ['number', 'string']:
+    return True
+  elif node.type == 'operator':
+    return node.value in literal_operators
+  elif node.type in ['keyword', 'name']:
+    return node.value in ['True', 'False', 'None']
+  return False
+
+def recurse_literal(node):
+  ## Fast path for literal subtrees: only transcode the leaves
+  s = []
+  for node in leaf_iter(node):
+    if '#' in node.prefix:
+      terminate_comments(node)
+    s.append(node.prefix)
+    if node.type == 'string':
+      if node.value[0] in '\'"' and '\\' not in node.value and \
+         '#' not in node.value:
+        s.append(node.value)  # no flags or escapes to transcode
+      else:
+        string = parse_string(node)
+        escape_raw_string(string)
+        s.append(string['quote'] + string['content'] + string['quote'])
+    elif node.value == 'True':
+      s.append('true')
+    elif node.value == 'False':
+      s.append('false')
+    elif node.value == 'None' and node.type == 'name':
+      s.append('null')
+    else:
+      s.append(node.value)
+  return ''.join(s)
+
 def recurse(node):
   if isinstance(node, CoffeeScript):
     ## Code already compiled into CoffeeScript
     return node.prefix + node.value
+  elif node.type == 'atom' and is_literal(node):
+    ## Data such as lists of numbers and strings
+    return recurse_literal(node)
 
   s = ''
   if isinstance(node, parso.python.tree.Leaf):
     if node.type == 'error_leaf':
-      warnings.warn('ERROR LEAF DETECTED: %s' % node)
+      warn('ERROR LEAF DETECTED: %s' % node)
     terminate_comments(node)
     s += node.prefix
 
@@ -477,10 +597,33 @@ def recurse(node):
       ## Avoid spaces before function and arguments in function call
       node.children[0].prefix = node.children[0].prefix.lstrip()
 
+    if node.type in ['for_stmt', 'comp_for', 'sync_comp_for'] and \
+       is_keyword(node.children[0], 'for'):
+      ## for i in range(len(xs)) -> for _x, i in xs (no index array)
+      args = call_args(node.children[3], 'range')
+      if is_name(node.children[1]) and args is not None and len(args) == 1:
+        args = call_args(args[0], 'len')
+        if args is not None and len(args) == 1 and \
+           value_type(args[0]) not in ['dict', 'set']:
+          index = node.children[1]
+          node.children[1] = CoffeeScript('_x, ' + index.value, ',',
+            index.prefix)
+          remove_prefix(args[0])
+          node.children[3] = CoffeeScript(recurse(args[0]), top_op(args[0]),
+            node.children[3].get_first_leaf().prefix)
+      ## for k in dict -> for k of dict; for x in set -> for x from set
+      kind = value_type(node.children[3])
+      if kind is not None and not is_name(node.children[1]):
+        warn('Unpacking in for loop over %s not converted' % kind)
+      elif kind == 'dict':
+        node.children[2].value = 'of'
+      elif kind == 'set':
+        node.children[2].value = 'from'
+
     if node.type == 'print_stmt':
       node.children[0].value = 'console.log'
       if is_operator(node.children[-1], ','):
-        warnings.warn('No known analog of print with comma to prevent newline')
+        warn('No known analog of print with comma to prevent newline')
 
     elif node.type == 'assert_stmt':
       node.children[0].value = 'console.assert'
@@ -508,7 +651,7 @@ def recurse(node):
             else:
               parameters.children[1].children[0].prefix = parameters.children[1].children[0].prefix.lstrip()
         else:
-          warnings.warn('method without self argument: %s' % self)
+          warn('method without self argument: %s' % self)
       else:
         node.children[1:1] = [CoffeeScript(' = ', 'leaf')]
       fix_parameters(node.children[2])
@@ -561,7 +704,7 @@ def recurse(node):
 
     elif node.type in ['atom_expr', 'power']:
       ## Literal string with format method immediately applied
-      if len(node.children) >= 3 and \
+      if may_contain('format') and len(node.children) >= 3 and \
          is_string(node.children[0]) and \
          is_method_trailer(node.children[1], 'format') and \
          is_call_trailer(node.children[2]):
@@ -581,6 +724,17 @@ def recurse(node):
           'leaf', node.children[0].prefix)
         node.children[1:3] = []
 
+      ## dict() -> {}, set() -> new Set()
+      elif len(node.children) >= 2 and \
+           is_empty_call_trailer(node.children[1]) and \
+           is_name(node.children[0]) and \
+           node.children[0].value in ['dict', 'set', 'frozenset']:
+        if node.children[0].value == 'dict':
+          empty = CoffeeScript('{}', 'leaf', node.children[0].prefix)
+        else:
+          empty = CoffeeScript('new Set()', '(', node.children[0].prefix)
+        node.children[:2] = [empty]
+
       ## Function call, possibly built-in
       elif len(node.children) >= 2 and is_name(node.children[0]) and \
            is_call_trailer(node.children[1]):
@@ -601,7 +755,33 @@ def recurse(node):
             else:
               r = CoffeeScript('(_i for _i in [%s...%s] by %s)' % args, '(', prefix)
           else:
-            warnings.warn('range with %d args' % len(args))
+            warn('range with %d args' % len(args))
+
+        elif function in ['set', 'frozenset']:
+          assert_simple_args(args, function)
+          if len(args) == 1 and display_type(args[0]) == 'set':
+            r = CoffeeScript(recurse(args[0]), '(', prefix)
+          elif len(args) == 1:
+            node.children[0].value = 'new Set'
+          else:
+            warn('%s() with %d arguments' % (function, len(args)))
+
+        elif function == 'list':
+          ## list(range(...)) -> [...], which CoffeeScript builds directly
+          if len(args) == 1 and call_args(args[0], 'range') is not None:
+            r = CoffeeScript(recurse(args[0]).lstrip(), top_op(args[0]),
+                  prefix)
+
+        elif function == 'sum':
+          ## sum(range(...)) -> counting loop without building the range
+          if len(args) == 1:
+            range_args = call_args(args[0], 'range')
+            if range_args is not None and 1 <= len(range_args) <= 3:
+              range_args = [recurse(arg).lstrip() for arg in range_args]
+              if len(range_args) == 1:
+                range_args.insert(0, '0')
+              r = CoffeeScript('%s(%s)' % (use_helper('_sumRange'),
+                    ', '.join(range_args)), '(', prefix)
 
         elif function in ['str', 'bin', 'oct', 'hex']:
           assert_simple_args(args, function)
@@ -619,7 +799,7 @@ def recurse(node):
             r = CoffeeScript(maybe_paren(args[0], '.') +
                   '.toString(%s)' % base, '.', prefix)
           else:
-            warnings.warn('%s() with %d arguments' % (function, len(args)))
+            warn('%s() with %d arguments' % (function, len(args)))
 
         elif function in ['int', 'float']:
           assert_simple_args(args, function)
@@ -631,7 +811,7 @@ def recurse(node):
             r = CoffeeScript(maybe_paren(args[0], '.') +
                   '.charCodeAt()', '.', prefix)
           else:
-            warnings.warn('%s() with %d arguments' % (function, len(args)))
+            warn('%s() with %d arguments' % (function, len(args)))
 
         elif function == 'chr':
           assert_simple_args(args, function)
@@ -639,7 +819,7 @@ def recurse(node):
             r = CoffeeScript('String.fromCharCode(%s)' %
               recurse(args[0]), '.', prefix)
           else:
-            warnings.warn('%s() with %d arguments' % (function, len(args)))
+            warn('%s() with %d arguments' % (function, len(args)))
 
         elif function == 'isinstance':
           assert_simple_args(args, function)
@@ -649,28 +829,37 @@ def recurse(node):
                maybe_paren(args[1], 'instanceof').lstrip()),
               'instanceof', prefix)
           else:
-            warnings.warn('%s() with %d arguments' % (function, len(args)))
+            warn('%s() with %d arguments' % (function, len(args)))
 
         elif function == 'len':
           assert_simple_args(args, function)
-          if len(args) == 1:
+          kind = len(args) == 1 and value_type(args[0])
+          if kind == 'dict':
+            r = CoffeeScript('Object.keys(%s).length' % recurse(args[0]),
+                  '.', prefix)
+          elif kind == 'set':
+            r = CoffeeScript('%s.size' % maybe_paren(args[0], '.'),
+                  '.', prefix)
+          elif len(args) == 1:
             r = CoffeeScript('%s.length' % maybe_paren(args[0], '.'),
                   '.', prefix)
           else:
-            warnings.warn('%s() with %d arguments' % (function, len(args)))
+            warn('%s() with %d arguments' % (function, len(args)))
 
         if r is not None:
           node.children[:2] = [r]
 
       ## this.x -> @x
-      elif len(node.children) >= 2 and is_name(node.children[0], 'this') and \
+      elif may_contain('class') and len(node.children) >= 2 and \
+           is_name(node.children[0], 'this') and \
            is_method_trailer(node.children[1]):
         if parso.tree.search_ancestor(node, 'classdef'):
           node.children[0].value = '@'
           del node.children[1].children[0]
 
       ## Module function call
-      elif len(node.children) >= 3 and is_name(node.children[0]) and \
+      elif may_contain('re') and len(node.children) >= 3 and \
+           is_name(node.children[0]) and \
            is_method_trailer(node.children[1]) and \
            is_call_trailer(node.children[2]):
         module = node.children[0].value
@@ -679,6 +868,7 @@ def recurse(node):
         function = module + '.' + method
         args = split_call_trailer(node.children[2])
         if module == 're':
+          r = None
           if method == 'sub':
             if len(args) >= 3:
               assert_simple_arg(args[0], function)
@@ -695,59 +885,103 @@ def recurse(node):
               replace_arg_in_call_trailer(node.children[2], 2)
               # Regular expression first argument
               if is_string(args[0]):
-                regexp = string_to_regexp(args[0], flags)
-                regexp.value += 'g'  # global replace
+                regexp = string_to_regexp(args[0], flags, 'g') # global replace
                 replace_arg_in_call_trailer(node.children[2], 0, regexp)
               # String replacement
               if is_string(args[1]):
                 regexp_backrefs(args[1])
             else:
-              warnings.warn('%d parameters passed to re.sub()' % len(args))
+              warn('%d parameters passed to re.sub()' % len(args))
+          elif method == 'compile':
+            # re.compile -> regexp
+            assert_simple_args(args, function)
+            if 1 <= len(args) <= 2 and is_string(args[0]):
+              r = string_to_regexp(args[0], find_arg(args, 'flags', 1)[1])
+              r.prefix = prefix
+            else:
+              warn('Unrecognized arguments to re.compile()')
+          elif method in ['search', 'match', 'fullmatch', 'split']:
+            # re.search etc. -> regexp.exec(string), string.split(regexp)
+            assert_simple_args(args, function)
+            flags = find_arg(args, 'flags', 3 if method == 'split' else 2)[1]
+            if 2 <= len(args) <= 3 and is_string(args[0]) and \
+               (flags is not None or len(args) == 2):
+              anchor = {'match': 'start', 'fullmatch': 'both'}.get(method)
+              regexp = string_to_regexp(args[0], flags, '', anchor)
+              remove_prefix(args[1])
+              if method == 'split':
+                r = CoffeeScript('%s.split(%s)' %
+                  (maybe_paren(args[1], '.'), regexp.value), '.', prefix)
+              else:
+                r = CoffeeScript('%s.exec(%s)' %
+                  (maybe_paren(regexp, '.'), recurse(args[1])), '.', prefix)
+            else:
+              warn('Unrecognized arguments to %s()' % function)
+          if r is not None:
+            node.children[:3] = [r]
 
       ## Method name mapping
-      for child in node.children:
-        if is_method_trailer(child) and child.children[1].value in method_mapping:
-          child.children[1].value = method_mapping[child.children[1].value]
-
-      ## .extend(x) -> .push(...x)
-      for i in range(len(node.children)-1):
-        if is_method_trailer(node.children[i], 'extend') and \
-           is_call_trailer(node.children[i+1]):
-          args = split_call_trailer(node.children[i+1])
-          if len(args) != 1:
-            warnings.warn('%d parameters passed to .extend()' % len(args))
-            continue
-          if is_node(args[0], 'argument') and is_operator(args[0][0], '*'):
-            warnings.warn('*args passed to .extend()')
-            continue
-          force_call_trailer_arglist(node.children[i+1])
-          if is_node(args[0], 'atom') and \
-             is_operator(args[0].children[0], '[') and \
-             is_node(args[0].children[1], 'testlist_comp') and \
-             is_operator(args[0].children[2], ']') and \
-             not any(child.type in ['comp_for', 'sync_comp_for']
-                     for child in args[0].children[1].children):
-            ## .extend([1, 2]) -> .push(1, 2)
-            node.children[i+1].children[1].children[0].children = \
-              node.children[i+1].children[1].children[0].children[1].children
-            set_children_parents(node.children[i+1].children[1])
-          else:
-            node.children[i+1].children[1].children.insert(0,
-              parso.python.tree.Operator('*',
-                node.children[i+1].children[1].children[0].start_pos))
-          node.children[i].children[1].value = 'push'
+      if may_contain(*method_mapping):
+        for child in node.children:
+          if is_method_trailer(child) and child.children[1].value in method_mapping:
+            child.children[1].value = method_mapping[child.children[1].value]
+
+      ## .extend(x) -> .push(...x), or _extend(array, x) for large arrays
+      if may_contain('extend'):
+        for i in range(len(node.children)-1):
+          if is_method_trailer(node.children[i], 'extend') and \
+             is_call_trailer(node.children[i+1]):
+            args = split_call_trailer(node.children[i+1])
+            if len(args) != 1:
+              warn('%d parameters passed to .extend()' % len(args))
+              continue
+            if is_node(args[0], 'argument') and is_operator(args[0][0], '*'):
+              warn('*args passed to .extend()')
+              continue
+            force_call_trailer_arglist(node.children[i+1])
+            if is_node(args[0], 'atom') and \
+               is_operator(args[0].children[0], '[') and \
+               is_node(args[0].children[1], 'testlist_comp') and \
+               is_operator(args[0].children[2], ']') and \
+               not any(child.type in ['comp_for', 'sync_comp_for']
+                       for child in args[0].children[1].children):
+              ## .extend([1, 2]) -> .push(1, 2)
+              node.children[i+1].children[1].children[0].children = \
+                node.children[i+1].children[1].children[0].children[1].children
+              set_children_parents(node.children[i+1].children[1])
+            elif current_conversion.get().extend == 'helper':
+              ## Spread arguments overflow the engine's argument limit for
+              ## large arrays, so push in chunks via a helper function.
+              first = 1 if is_keyword(node.children[0], 'await') else 0
+              if i - first == 1:
+                array = node.children[first]
+              else:
+                array = parso.python.tree.PythonNode('atom_expr',
+                  node.children[first:i])
+              prefix = array.get_first_leaf().prefix
+              remove_prefix(array)
+              remove_prefix(args[0])
+              node.children[first:i+2] = [CoffeeScript('%s(%s, %s)' %
+                (use_helper('_extend'), recurse(array), recurse(args[0])),
+                '(', prefix)]
+              break
+            else:
+              node.children[i+1].children[1].children.insert(0,
+                parso.python.tree.Operator('*',
+                  node.children[i+1].children[1].children[0].start_pos))
+            node.children[i].children[1].value = 'push'
 
     elif node.type in ['for_stmt', 'while_stmt', 'if_stmt']:
       assert is_keyword(node.children[0], node.type.split('_', 1)[0])
       for i, child in reversed(list(enumerate(node.children))):
         if is_operator(child, ':'):
           if child.prefix:
-            warnings.warn('Discarding prefix %r to colon' % child.prefix)
+            warn('Discarding prefix %r to colon' % child.prefix)
           del node.children[i]
         if is_keyword(child, 'elif'):
           child.value = 'else if'
         elif is_keyword(child, 'else') and node.type != 'if_stmt':
-          warnings.warn('No support for else clause in %s' % node.type)
+          warn('No support for else clause in %s' % node.type)
 
       if node.type == 'while_stmt' and is_true(node.children[1]):
         node.children[0].value = 'loop'
@@ -779,6 +1013,55 @@ def recurse(node):
       assert is_operator(node.children[-2], ':')
       del node.children[-2]
 
+    elif node.type == 'atom' and display_type(node) == 'set':
+      ## {x, y} -> new Set([x, y]); {x for ...} -> new Set(x for ...)
+      if is_node(node.children[1], 'dictorsetmaker') and \
+         node.children[1].children[-1].type in ['comp_for', 'sync_comp_for']:
+        node.children[0] = CoffeeScript('new Set(', '(', node.children[0].prefix)
+        node.children[-1] = CoffeeScript(')', '(', node.children[-1].prefix)
+      else:
+        node.children[0] = CoffeeScript('new Set([', '(',
+          node.children[0].prefix)
+        node.children[-1] = CoffeeScript('])', '(', node.children[-1].prefix)
+
+    elif node.type == 'comparison' and len(node.children) == 3 and \
+         (is_keyword(node.children[1], 'in') or
+          is_node(node.children[1], 'comp_op') and
+          is_keyword(node.children[1].children[0], 'not') and
+          is_keyword(node.children[1].children[1], 'in')):
+      ## Membership in dict or set: in -> of or .has
+      negate = node.children[1].type == 'comp_op'
+      container = node.children[2]
+      kind = value_type(container)
+      if kind == 'dict':
+        if negate:
+          node.children[1].children[1].value = 'of'
+        else:
+          node.children[1].value = 'of'
+      elif kind == 'set' and container.type == 'atom':
+        ## x in {a, b} -> x in [a, b], which CoffeeScript unrolls into ==s
+        container.children[0].value = '['
+        container.children[-1].value = ']'
+      elif kind == 'set':
+        prefix = node.children[0].get_first_leaf().prefix
+        remove_prefix(node.children[0])
+        remove_prefix(container)
+        has = '%s.has(%s)' % (maybe_paren(container, '.'),
+          recurse(node.children[0]))
+        if negate:
+          node.children = [CoffeeScript('not ' + has, 'not', prefix)]
+        else:
+          node.children = [CoffeeScript(has, '.', prefix)]
+
+    elif node.type in set_operators.values():
+      ## Set operators (e.g. |) would silently work on numbers instead
+      for i in range(1, len(node.children) - 1, 2):
+        op = node.children[i]
+        if is_operator(op) and op.value in set_operators and \
+           'set' in [value_type(node.children[i-1]),
+                     value_type(node.children[i+1])]:
+          warn('Set operator %s not converted' % op.value)
+
     elif node.type in ['test']:
       if is_keyword(node.children[1], 'if') and \
          is_keyword(node.children[3], 'else'):
@@ -798,33 +1081,1394 @@ def recurse(node):
 def recurse_list(node_list):
   return ''.join(map(recurse, node_list))
 
-def convert_tree(node):
-  # Escape existing use of CoffeeScript keywords not in Python
-  name_replace(node, re.compile(r'^_*(this|function)$'), r'_\g<0>')
-  return recurse(node)
+# Existing use of CoffeeScript keywords not in Python
+reserved_name = re.compile(r'^_*(this|function)$')
+def escape_reserved(node):
+  name_replace(node, reserved_name, r'_\g<0>')
+
+## CoffeeScript definitions of helper functions that converted code may call
+helpers = {
+  '_extend': '''\
+_extend = (array, items) ->
+  items = Array.from items unless Array.isArray items  # e.g. Set, string
+  for i in [0...items.length] by 10000
+    array.push items[i...i+10000]...
+  return
+''',
+  '_sumRange': '''\
+_sumRange = (start, stop, step = 1) ->
+  total = 0
+  total += i for i in [start...stop] by step
+  total
+''',
+}
+
+def use_helper(name):
+  current_conversion.get().helpers_used.add(name)
+  return name
+
+def add_prelude(cs):
+  '''Prepend definitions of the helpers and hoisted regexps used by cs'''
+  conversion = current_conversion.get()
+  definitions = ''.join(helpers[name]
+    for name in sorted(conversion.helpers_used))
+  definitions += ''.join('%s = %s\n' % (name, regexp)
+    for regexp, name in (conversion.hoisted_regexps or {}).items())
+  if not definitions:
+    return cs
+  definitions += '\n'
+  if cs.startswith('#!'):  ## keep shebang line first
+    line_end = cs.find('\n') + 1 or len(cs)
+    return cs[:line_end] + definitions + cs[line_end:]
+  return definitions + cs
+
+## Set operators (which CoffeeScript lacks) and the nodes containing them
+set_operators = {'|': 'expr', '^': 'xor_expr', '&': 'and_expr',
+  '-': 'arith_expr', '|=': 'expr_stmt', '^=': 'expr_stmt', '&=': 'expr_stmt',
+  '-=': 'expr_stmt'}
+
+## Types of dicts and sets, for choosing CoffeeScript operations
+## (e.g. of instead of in).  Dicts become objects and sets become Sets.
+annotation_types = {
+  'dict': 'dict', 'Dict': 'dict',
+  'set': 'set', 'Set': 'set', 'frozenset': 'set', 'FrozenSet': 'set',
+}
+scope_types = {'funcdef', 'lambdef', 'classdef'}
+## Nodes that bind names (besides parameters), and that use names as
+## operands of in, for, len(), or set operators
+definer_types = {'expr_stmt', 'for_stmt', 'sync_comp_for', 'with_stmt',
+  'import_name', 'import_from', 'del_stmt', 'global_stmt', 'nonlocal_stmt',
+  'namedexpr_test'}
+use_types = {'comparison', 'for_stmt', 'sync_comp_for', 'trailer'} | \
+  set(set_operators.values())
+## Nodes that may contain statements
+compound_types = {'suite', 'simple_stmt', 'if_stmt', 'while_stmt', 'for_stmt', 'try_stmt',
+  'with_stmt', 'funcdef', 'classdef', 'decorated', 'async_stmt',
+  'async_funcdef'}
+
+def display_type(node):
+  ## 'dict' or 'set' for {...} displays, None for other nodes
+  if node.type != 'atom' or not is_operator(node.children[0], '{'):
+    return None
+  if len(node.children) == 2:
+    return 'dict'  # {}
+  inside = node.children[1]
+  if is_node(inside, 'dictorsetmaker'):
+    if any(is_operator(child, ':') or is_operator(child, '**')
+           for child in inside.children):
+      return 'dict'
+  return 'set'
+
+def value_type(node):
+  ## 'dict' or 'set' if node is known to evaluate to one, else None
+  if node.type == 'name':
+    conversion = current_conversion.get(None)
+    return conversion and conversion.name_types.get(node)
+  elif node.type == 'atom':
+    return display_type(node)
+  elif call_args(node, 'dict') is not None:
+    return 'dict'
+  elif call_args(node, 'set') is not None or \
+       call_args(node, 'frozenset') is not None:
+    return 'set'
+
+def annotation_type(node):
+  ## 'dict' or 'set' for annotations like dict, Set[int], typing.Dict[K, V]
+  if node.type in ['atom_expr', 'power']:
+    trailers = node.children[1:]
+    while trailers and is_operator(trailers[-1].children[0], '['):
+      trailers = trailers[:-1]
+    if not trailers:
+      node = node.children[0]
+    elif len(trailers) == 1 and is_name(node.children[0], 'typing') and \
+         is_method_trailer(trailers[0]):
+      node = trailers[0].children[1]
+  if node.type == 'name':
+    return annotation_types.get(node.value)
+
+def declarations_in(node):
+  ## global and nonlocal statements within node, e.g. the body of a scope
+  ## (statements can't be nested within expressions, so skip those)
+  if node.type in ['global_stmt', 'nonlocal_stmt']:
+    yield node
+  elif node.type in compound_types:
+    for child in node.children:
+      yield from declarations_in(child)
+
+def infer_types(tree, region = None):
+  '''Map name leaves that surely refer to a dict or set to 'dict' or 'set'.
+
+  Flow-insensitive: a name has a type if every binding of the name in its
+  scope gives it that type, via a display like {...}, a call like dict(),
+  or an annotation like Dict[str, int].
+  If region is a (start, end) pair of positions, only scopes overlapping it
+  (those enclosing or within the region) get visited, besides the module.
+  '''
+  bindings = {}  # (scope, name) -> set of types, None meaning unknown
+  definitions = {}  # name leaf -> node defining it
+  enclosing = {}  # scope -> enclosing scope
+  uses = []
+  declarations = []  # (scope, name, 'global' or 'nonlocal')
+  def name(node, scope):
+    if node in definitions:
+      definition = definitions[node]
+      if definition.type in ['global_stmt', 'nonlocal_stmt']:
+        declarations.append((scope, node.value, definition.children[0].value))
+        return
+      binding = bindings.setdefault((scope, node.value), set())
+      kind = None
+      if definition.type == 'expr_stmt':
+        if is_node(definition.children[1], 'annassign'):
+          annassign = definition.children[1].children
+          kind = annotation_type(annassign[1])
+          if kind is None and len(annassign) == 4:
+            kind = value_type(annassign[3])
+        elif not is_operator(definition.children[1], '='):
+          uses.append((scope, node))  # possible operand of a set operator
+          return  # augmented assignment does not change the type
+        elif any(target is node for target in definition.children[:-1:2]):
+          kind = value_type(definition.children[-1])
+      elif definition.type == 'param' and \
+           definition.annotation is not None and not definition.star_count:
+        kind = annotation_type(definition.annotation)
+      binding.add(kind)
+      return
+    parent = node.parent
+    if parent.type in use_types:
+      if parent.type != 'trailer' or is_call_trailer(parent):
+        uses.append((scope, node))  # possible operand of in, for, or len()
+    elif parent.type in ['funcdef', 'classdef'] and \
+         node is parent.children[1] or \
+         parent.type == 'except_clause' and \
+         is_keyword(node.get_previous_sibling(), 'as'):
+      bindings.setdefault((scope, node.value), set()).add(None)
+  def visit(node, scope):
+    if node.type in definer_types:
+      for defined in node.get_defined_names():
+        definitions[defined] = node
+    for child in node.children:
+      if child.type == 'name':
+        name(child, scope)
+      elif isinstance(child, parso.python.tree.Leaf):
+        continue
+      elif child.type in scope_types:
+        ## Parameter names and the body are in the new scope; the rest of
+        ## the header (name, defaults, annotations) is in the enclosing scope.
+        enclosing[child] = scope
+        if region is not None and (child.end_pos <= region[0] or
+                                   child.start_pos >= region[1]):
+          if child.type != 'lambdef':
+            name(child.children[1], scope)  # bind only the def/class name
+          ## Names it declares global or nonlocal may get rebound anywhere
+          for declaration in declarations_in(child.children[-1]):
+            for declared in declaration.get_defined_names():
+              if declaration.type == 'global_stmt':
+                bindings.setdefault((tree, declared.value), set()).add(None)
+              else:
+                outer = scope
+                while outer is not tree:
+                  if outer.type != 'classdef':
+                    bindings.setdefault((outer, declared.value),
+                      set()).add(None)
+                  outer = enclosing[outer]
+          continue
+        for part in child.children:
+          if part is child.children[-1]:
+            visit_child(part, child)
+          elif part.type in ['parameters', 'param']:
+            for param in part.children if part.type == 'parameters' \
+                         else [part]:
+              if param.type == 'param':
+                definitions[param.name] = param
+                for piece in param.children:
+                  visit_child(piece, child if piece is param.name else scope)
+          else:
+            visit_child(part, scope)
+      else:
+        visit(child, scope)
+  def visit_child(node, scope):
+    if node.type == 'name':
+      name(node, scope)
+    elif isinstance(node, parso.python.tree.BaseNode):
+      visit(node, scope)
+  def resolve(scope, name):
+    ## Scope whose binding of name applies within scope
+    while (scope, name) not in bindings and scope is not tree:
+      scope = enclosing[scope]
+      while scope.type == 'classdef':  # class scope not visible in methods
+        scope = enclosing[scope]
+    return redirects.get((scope, name), scope)
+  visit(tree, tree)
+  ## Bindings of names declared global or nonlocal belong to the module or
+  ## enclosing scope that they rebind
+  redirects = {}  # (scope, name) -> scope
+  for scope, name, kind in declarations:
+    binding = bindings.pop((scope, name), set())
+    if kind == 'global':
+      target = tree
+    else:
+      target = enclosing[scope]
+      while target.type == 'classdef':
+        target = enclosing[target]
+      target = resolve(target, name)
+    bindings.setdefault((target, name), set()).update(binding)
+    redirects[scope, name] = target
+    bindings[scope, name] = set()  # resolve via redirects
+  types = {}
+  for scope, leaf in uses:
+    scope = resolve(scope, leaf.value)
+    binding = bindings.get((scope, leaf.value))
+    if binding is not None and len(binding) == 1 and None not in binding:
+      types[leaf] = next(iter(binding))
+  return types
+
+class Conversion:
+  '''Options and state of one conversion.
+
+  Each call to convert_tree or convert_range works within its own
+  Conversion, so conversions can run concurrently in several threads.
+  Problems found while converting get collected in diagnostics.
+  '''
+  def __init__(self, extend = 'spread', prescan = True):
+    self.extend = extend  # .extend(x) -> 'spread' (.push(...x)) or 'helper'
+    self.prescan = prescan  # whether to skip rules that can't apply
+    self.diagnostics = []
+    self.helpers_used = set()
+    self.hoisted_regexps = {}  # CoffeeScript code -> constant name, or None
+    self.name_types = {}  # see infer_types
+    self.tokens = None  # see prescan; None means unknown
+
+  def warn(self, message):
+    if message not in self.diagnostics:
+      self.diagnostics.append(message)
+
+current_conversion = contextvars.ContextVar('current_conversion')
+
+def warn(message):
+  conversion = current_conversion.get(None)
+  if conversion is None:
+    warnings.warn(message)
+  else:
+    conversion.warn(message)
+
+@contextlib.contextmanager
+def converting(conversion):
+  ## Runs the body within conversion.  Without one, uses a default
+  ## Conversion, whose diagnostics then get issued as warnings.
+  report = conversion is None
+  if report:
+    conversion = Conversion()
+  token = current_conversion.set(conversion)
+  try:
+    yield conversion
+  finally:
+    current_conversion.reset(token)
+  if report:
+    for message in conversion.diagnostics:
+      warnings.warn(message)
+
+def prescan(tree):
+  '''Set of the names, keywords, and operators in the tree.
+
+  Rules that look for particular names (e.g. re, .format, .extend) can't
+  fire on code without them, so they get skipped (see may_contain).
+  '''
+  tokens = set()
+  stack = [tree]
+  while stack:
+    node = stack.pop()
+    if isinstance(node, parso.python.tree.BaseNode):
+      stack.extend(node.children)
+    elif node.type in ['name', 'keyword', 'operator']:
+      tokens.add(node.value)
+  return tokens
+
+def may_contain(*tokens):
+  ## Whether the code being converted may contain any of the tokens
+  conversion = current_conversion.get(None)
+  return conversion is None or conversion.tokens is None or \
+    not conversion.tokens.isdisjoint(tokens)
+
+def prepare(tree, conversion, statements = None):
+  ## Prescan and infer types over the whole tree, before converting any of it.
+  ## When converting just some statements, prescan only them, and infer types
+  ## only in the module and the scopes enclosing them.
+  if not conversion.prescan:  # try all rules (see compare_prescan.py)
+    conversion.tokens = None
+    conversion.name_types = infer_types(tree, statements and
+      (statements[0].start_pos, statements[-1].end_pos))
+  elif statements is None:
+    conversion.tokens = prescan(tree)
+    if '{' in conversion.tokens or \
+       not conversion.tokens.isdisjoint(annotation_types):
+      conversion.name_types = infer_types(tree)
+  else:
+    conversion.tokens = set()
+    for statement in statements:
+      conversion.tokens |= prescan(statement)
+    if parso.tree.search_ancestor(statements[0], 'classdef'):
+      conversion.tokens.add('class')  # for this.x -> @x
+    if not conversion.tokens.isdisjoint(['in', 'len', *set_operators]):
+      ## see use_types
+      conversion.name_types = infer_types(tree,
+        (statements[0].start_pos, statements[-1].end_pos))
+
+def convert_tree(node, conversion = None):
+  '''Convert parso tree into CoffeeScript code, modifying the tree.
+
+  conversion is an optional Conversion giving options and collecting
+  diagnostics; by default, diagnostics get issued as warnings.
+  '''
+  with converting(conversion) as conversion:
+    prepare(node, conversion)
+    if conversion.tokens is None or \
+       any(map(reserved_name.search, conversion.tokens)):
+      escape_reserved(node)
+    return add_prelude(recurse(node))
+
+def convert_code(code, version = '3.6', parser = 'parso', conversion = None):
+  '''Convert a string of Python code into CoffeeScript code'''
+  with converting(conversion) as conversion:
+    return convert_tree(frontends[parser](code, version), conversion)
+
+def method_self(funcdef):
+  ## Returns the first (self) parameter of a class method, or None.
+  if funcdef.parent and funcdef.parent.parent and \
+     funcdef.parent.parent.type == 'classdef':
+    params = funcdef.children[2].children
+    if len(params) > 2 and is_name(params[1].children[0]):
+      return params[1].children[0]
+
+def find_statements(tree, start, end):
+  '''Smallest sequence of statements enclosing the (line, column) range'''
+  start = min(start, tree.end_pos)
+  end = max(start, min(end, tree.end_pos))
+  first = tree.get_leaf_for_position(start, include_prefixes=True)
+  if first.end_pos <= start and first.get_next_leaf() is not None:
+    first = first.get_next_leaf()  # start of the following line
+  last = tree.get_leaf_for_position(end, include_prefixes=True)
+  if end > start and last.start_pos >= end and \
+     last.get_previous_leaf() is not None:
+    last = last.get_previous_leaf()  # exclusive end
+  if last.start_pos < first.start_pos:
+    last = first
+  ancestors = set()
+  node = first
+  while node is not None:
+    ancestors.add(node)
+    node = node.parent
+  common = last
+  while common not in ancestors:
+    common = common.parent
+  if common.type not in ['file_input', 'suite']:
+    while common.parent.type not in ['file_input', 'suite']:
+      common = common.parent
+    return [common]
+  def child_containing(leaf):
+    while leaf.parent is not common:
+      leaf = leaf.parent
+    return leaf
+  first = common.children.index(child_containing(first))
+  last = common.children.index(child_containing(last))
+  return [child for child in common.children[first:last+1]
+          if not is_newline(child) and child.type != 'endmarker']
+
+def convert_range(tree, start, end, conversion = None):
+  '''Convert only the statements enclosing the (line, column) range.
+
+  Returns the CoffeeScript along with the (line, column) range of Python code
+  that it replaces.  The rest of the tree is left as context (enclosing
+  classes and methods) and is not converted.
+  '''
+  with converting(conversion) as conversion:
+    statements = find_statements(tree, start, end)
+    if not statements:
+      return '', start, start
+    prepare(tree, conversion, statements)
+    ## Module-level regexp constants can't be added from within the range,
+    ## and might clash with those of the rest of the converted file
+    ## (helpers get reported instead; see below)
+    conversion.hoisted_regexps = None
+    ## Drop comments before the first statement, but keep its indentation
+    first = statements[0].get_first_leaf()
+    first.prefix = first.prefix[first.prefix.rfind('\n')+1:]
+    region = (first.start_pos[0], 0), statements[-1].end_pos
+    ## Enclosing methods would have replaced self with this
+    selves = []
+    node = statements[0].parent
+    while node is not None:
+      if node.type == 'funcdef':
+        self = method_self(node)
+        if self is not None:
+          selves.append(reserved_name.sub(r'_\g<0>', self.value))
+      node = node.parent
+    for statement in statements:
+      escape_reserved(statement)
+      for self in selves:
+        name_replace(statement, self, 'this')
+    cs = recurse_list(statements)
+    ## Helper definitions belong at the top of the file, not in the range
+    for name in sorted(conversion.helpers_used):
+      warn('Converted code uses helper %s, which must be defined at the top '
+           'of the file:\n%s' % (name, helpers[name].rstrip('\n')))
+    return (cs,) + region
+
+## Frontends parse Python code into a parso tree, which is what convert_tree
+## and recurse operate on.  Each takes the code and a Python version string.
+
+def parse_parso(code, version, path = None):
+  ## With the path of a file containing code, parso caches the tree on disk,
+  ## so parsing the unchanged file again just loads it
+  if path is None:
+    return parso.parse(code, version=version)
+  tree = parso.parse(code, version=version, path=path, cache=True)
+  ## Converting modifies the tree, so don't let parso reuse it from memory
+  parso.cache.parser_cache.clear()
+  return tree
+
+binop_types = {
+  ast.BitOr: 'expr',
+  ast.BitXor: 'xor_expr',
+  ast.BitAnd: 'and_expr',
+  ast.LShift: 'shift_expr',
+  ast.RShift: 'shift_expr',
+  ast.Add: 'arith_expr',
+  ast.Sub: 'arith_expr',
+  ast.Mult: 'term',
+  ast.MatMult: 'term',
+  ast.Div: 'term',
+  ast.FloorDiv: 'term',
+  ast.Mod: 'term',
+  ast.Pow: 'power',
+}
+compound_stmts = (ast.If, ast.For, ast.AsyncFor, ast.While, ast.Try, ast.With,
+  ast.AsyncWith, ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+## Python 3.12+ splits f-strings into several tokens
+FSTRING_START = getattr(tokenize, 'FSTRING_START', None)
+FSTRING_END = getattr(tokenize, 'FSTRING_END', None)
+
+class AstTreeBuilder:
+  '''Build the same tree as parso, using the stdlib ast and tokenize modules.
+
+  The ast provides the structure, and the token stream provides the leaves
+  along with their prefixes (whitespace and comments), so that the original
+  layout is preserved just like with parso.
+  '''
+  def __init__(self, code, version):
+    ## parso leaves a byte order mark out of positions, but keeps it in the
+    ## prefix of the first leaf
+    bom = '\ufeff' if code.startswith('\ufeff') else ''
+    code = code[len(bom):]
+    self.code = code
+    self.version_string = version
+    self.version = parso.utils.parse_version_string(version)
+    if self.version.major < 3:
+      raise NotImplementedError('ast parser supports only Python 3 code')
+    self.keywords = \
+      parso.load_grammar(version=version)._pgen_grammar.reserved_syntax_strings
+    self.lines = io.StringIO(code).readlines()
+    offsets = [0]
+    for line in self.lines:
+      offsets.append(offsets[-1] + len(line))
+    def offset(pos):
+      return offsets[pos[0]-1] + pos[1]
+    ## Tokens are (type, value, start_pos, end_pos, prefix)
+    self.tokens = []
+    opens = []
+    self.match = {}
+    last = 0
+    skip = (tokenize.COMMENT, tokenize.NL, tokenize.INDENT, tokenize.DEDENT,
+            tokenize.ENDMARKER)
+    fstring_depth = 0
+    for type, string, start, end, line in \
+        tokenize.generate_tokens(io.StringIO(code).readline):
+      if fstring_depth:
+        if type == FSTRING_START:
+          fstring_depth += 1
+        elif type == FSTRING_END:
+          fstring_depth -= 1
+          if not fstring_depth:
+            self.tokens[-1] = self.tokens[-1][:3] + (end,) + self.tokens[-1][4:]
+            last = offset(end)
+        continue
+      if type in skip or (type == tokenize.NEWLINE and not string):
+        continue
+      if type == FSTRING_START:
+        fstring_depth = 1
+      if string in ['(', '[', '{']:
+        opens.append(len(self.tokens))
+      elif string in [')', ']', '}']:
+        self.match[opens.pop()] = len(self.tokens)
+      self.tokens.append((type, string, start, end, code[last:offset(start)]))
+      last = offset(end)
+    ## parso puts the endmarker right after the last character
+    self.tokens.append((tokenize.ENDMARKER, '',
+      (code.count('\n') + 1, len(code) - code.rfind('\n') - 1), None,
+      code[last:]))
+    self.tokens[0] = self.tokens[0][:4] + (bom + self.tokens[0][4],)
+    self.index = 0
+    self.tree = ast.parse(code,
+      feature_version=(self.version.major, self.version.minor))
+
+  def build(self):
+    children = self.stmts(self.tree.body)
+    children.append(self.leaf())
+    return parso.python.tree.Module(children)
+
+  ## Tokens
+
+  def peek(self):
+    return self.tokens[self.index][1]
+  def peek_type(self):
+    return self.tokens[self.index][0]
+  def peek_start(self):
+    return self.tokens[self.index][2]
+
+  def leaf(self):
+    type, value, start_pos, end_pos, prefix = self.tokens[self.index]
+    self.index += 1
+    if type == tokenize.NAME:
+      if value in self.keywords:
+        return parso.python.tree.Keyword(value, start_pos, prefix)
+      else:
+        return parso.python.tree.Name(value, start_pos, prefix)
+    elif type == tokenize.NUMBER:
+      return parso.python.tree.Number(value, start_pos, prefix)
+    elif type == tokenize.STRING or type == FSTRING_START:
+      if type == FSTRING_START or \
+         'f' in re.match(r'[a-zA-Z]*', value).group(0).lower():
+        return self.fstring(start_pos, end_pos, prefix)
+      return parso.python.tree.String(value, start_pos, prefix)
+    elif type == tokenize.NEWLINE:
+      return parso.python.tree.Newline(value, start_pos, prefix)
+    elif type == tokenize.ENDMARKER:
+      return parso.python.tree.EndMarker(value, start_pos, prefix)
+    else:
+      return parso.python.tree.Operator(value, start_pos, prefix)
+
+  def expect(self, value):
+    if self.peek() != value:  # tokens laid out in a way not handled yet
+      raise NotImplementedError('ast parser expected %r but found %r at %s' %
+        (value, self.peek(), self.peek_start()))
+    return self.leaf()
+
+  def fstring(self, start_pos, end_pos, prefix):
+    ## f-string contents are not in the ast (before 3.12) or the token stream,
+    ## so let parso parse just the f-string.
+    (start_line, start_column), (end_line, end_column) = start_pos, end_pos
+    lines = self.lines[start_line-1:end_line]
+    lines[-1] = lines[-1][:end_column]
+    lines[0] = lines[0][start_column:]
+    module = parso.parse(''.join(lines), version=self.version_string)
+    first = module.get_first_leaf()
+    node = first.parent
+    assert node.type == 'fstring'
+    for leaf in leaf_iter(node):
+      if leaf.line == 1:
+        leaf.column += start_column
+      leaf.line += start_line - 1
+    first.prefix = prefix
+    return node
+
+  ## Nodes
+
+  def make(self, type, children):
+    ## Like parso, omit empty nodes and collapse nodes with just one child
+    children = [child for child in children if child is not None]
+    if not children:
+      return None
+    elif len(children) == 1:
+      return children[0]
+    node_class = parso.python.parser.Parser.node_map.get(type)
+    if node_class is None:
+      return parso.python.tree.PythonNode(type, children)
+    return node_class(children)
+
+  def start(self, node):
+    return node.lineno, self.column(node.lineno, node.col_offset)
+  def end(self, node):
+    return node.end_lineno, self.column(node.end_lineno, node.end_col_offset)
+  def column(self, lineno, col_offset):
+    ## ast column offsets count UTF-8 bytes
+    line = self.lines[lineno-1]
+    if line.isascii():
+      return col_offset
+    return len(line.encode('utf8')[:col_offset].decode('utf8', 'replace'))
+
+  def own_parens(self, node):
+    ## Whether node's source starts with ( and ends with the matching )
+    return self.peek() == '(' and self.peek_start() == self.start(node) and \
+      self.tokens[self.match[self.index]][3] == self.end(node)
+
+  ## Statements
+
+  def stmts(self, body):
+    children = []
+    i = 0
+    while i < len(body):
+      if isinstance(body[i], compound_stmts):
+        children.append(self.stmt(body[i]))
+        i += 1
+        continue
+      ## Small statements separated by semicolons
+      small = [self.stmt(body[i])]
+      i += 1
+      while self.peek() == ';':
+        small.append(self.leaf())
+        if self.peek_type() in [tokenize.NEWLINE, tokenize.ENDMARKER]:
+          break
+        small.append(self.stmt(body[i]))
+        i += 1
+      if self.peek_type() == tokenize.NEWLINE:
+        small.append(self.leaf())
+      children.append(self.make('simple_stmt', small))
+    return children
+
+  def method(self, kind, node, name = None):
+    ## Method building the tree for the ast node, e.g. stmt_If for ast.If
+    name = name or node.__class__.__name__
+    method = getattr(self, kind + '_' + name, None)
+    if method is None:
+      raise NotImplementedError('ast parser does not support %s' %
+        node.__class__.__name__)
+    return method
+
+  def stmt(self, node):
+    return self.method('stmt', node)(node)
+
+  def suite(self, body):
+    if self.peek_type() == tokenize.NEWLINE:
+      return self.make('suite', [self.leaf()] + self.stmts(body))
+    else: # one-liner
+      [stmt] = self.stmts(body)
+      return stmt
+
+  def stmt_Expr(self, node):
+    return self.expr(node.value)
+
+  def stmt_Assign(self, node):
+    children = []
+    for target in node.targets:
+      children.extend([self.expr(target), self.expect('=')])
+    children.append(self.expr(node.value))
+    return self.make('expr_stmt', children)
+
+  def stmt_AugAssign(self, node):
+    return self.make('expr_stmt', [self.expr(node.target), self.leaf(),
+      self.expr(node.value, 'testlist')])
+
+  def stmt_AnnAssign(self, node):
+    target = self.expr(node.target)
+    annassign = [self.expect(':'), self.expr(node.annotation)]
+    if node.value is not None:
+      annassign.extend([self.expect('='), self.expr(node.value)])
+    return self.make('expr_stmt', [target, self.make('annassign', annassign)])
+
+  def stmt_Return(self, node):
+    children = [self.expect('return')]
+    if node.value is not None:
+      if self.version < (3, 8):
+        children.append(self.expr(node.value, 'testlist'))
+      else:
+        children.append(self.expr(node.value))
+    return self.make('return_stmt', children)
+
+  def stmt_Delete(self, node):
+    return self.make('del_stmt', [self.expect('del'),
+      self.make('exprlist', self.commas(node.targets, self.expr))])
+
+  def stmt_Pass(self, node):
+    return self.expect('pass')
+  def stmt_Break(self, node):
+    return self.expect('break')
+  def stmt_Continue(self, node):
+    return self.expect('continue')
+
+  def stmt_Raise(self, node):
+    children = [self.expect('raise')]
+    if node.exc is not None:
+      children.append(self.expr(node.exc))
+    if node.cause is not None:
+      children.extend([self.expect('from'), self.expr(node.cause)])
+    return self.make('raise_stmt', children)
+
+  def stmt_Global(self, node):
+    children = [self.expect('global')]
+    for name in node.names:
+      if len(children) > 1:
+        children.append(self.expect(','))
+      children.append(self.leaf())
+    return self.make('global_stmt', children)
+  def stmt_Nonlocal(self, node):
+    children = [self.expect('nonlocal')]
+    for name in node.names:
+      if len(children) > 1:
+        children.append(self.expect(','))
+      children.append(self.leaf())
+    return self.make('nonlocal_stmt', children)
+
+  def stmt_Assert(self, node):
+    children = [self.expect('assert'), self.expr(node.test)]
+    if node.msg is not None:
+      children.extend([self.expect(','), self.expr(node.msg)])
+    return self.make('assert_stmt', children)
+
+  def dotted_name(self):
+    children = [self.leaf()]
+    while self.peek() == '.':
+      children.extend([self.leaf(), self.leaf()])
+    return self.make('dotted_name', children)
+  def as_name(self, type, name):
+    if self.peek() == 'as':
+      return self.make(type, [name, self.leaf(), self.leaf()])
+    return name
+
+  def stmt_Import(self, node):
+    keyword = self.expect('import')
+    names = self.commas(node.names,
+      lambda alias: self.as_name('dotted_as_name', self.dotted_name()))
+    return self.make('import_name',
+      [keyword, self.make('dotted_as_names', names)])
+
+  def stmt_ImportFrom(self, node):
+    children = [self.expect('from')]
+    while self.peek() in ['.', '...']:
+      children.append(self.leaf())
+    if node.module is not None:
+      children.append(self.dotted_name())
+    children.append(self.expect('import'))
+    if self.peek() == '*':
+      children.append(self.leaf())
+      return self.make('import_from', children)
+    paren = self.peek() == '('
+    if paren:
+      children.append(self.leaf())
+    names = self.commas(node.names,
+      lambda alias: self.as_name('import_as_name', self.leaf()))
+    children.append(self.make('import_as_names', names))
+    if paren:
+      children.append(self.expect(')'))
+    return self.make('import_from', children)
+
+  def stmt_If(self, node):
+    children = [self.expect('if'), self.expr(node.test), self.expect(':'),
+      self.suite(node.body)]
+    while node.orelse:
+      if self.peek() == 'elif':
+        node = node.orelse[0]
+        children.extend([self.leaf(), self.expr(node.test), self.expect(':'),
+          self.suite(node.body)])
+      else:
+        children.extend(self.else_suite(node.orelse))
+        break
+    return self.make('if_stmt', children)
+
+  def else_suite(self, body, keyword = 'else'):
+    if not body:
+      return []
+    return [self.expect(keyword), self.expect(':'), self.suite(body)]
+
+  def stmt_While(self, node):
+    return self.make('while_stmt', [self.expect('while'), self.expr(node.test),
+      self.expect(':'), self.suite(node.body)] + self.else_suite(node.orelse))
+
+  def stmt_For(self, node):
+    return self.make('for_stmt', [self.expect('for'),
+      self.expr(node.target, 'exprlist'), self.expect('in'),
+      self.expr(node.iter, 'testlist'), self.expect(':'),
+      self.suite(node.body)] + self.else_suite(node.orelse))
+
+  def stmt_Try(self, node):
+    children = [self.expect('try'), self.expect(':'), self.suite(node.body)]
+    for handler in node.handlers:
+      clause = [self.expect('except')]
+      if handler.type is not None:
+        clause.append(self.expr(handler.type))
+      if handler.name is not None:
+        clause.extend([self.expect('as'), self.leaf()])
+      children.extend([self.make('except_clause', clause), self.expect(':'),
+        self.suite(handler.body)])
+    children.extend(self.else_suite(node.orelse))
+    children.extend(self.else_suite(node.finalbody, 'finally'))
+    return self.make('try_stmt', children)
+
+  def stmt_With(self, node):
+    def with_item(item):
+      children = [self.expr(item.context_expr)]
+      if item.optional_vars is not None:
+        children.extend([self.expect('as'), self.expr(item.optional_vars)])
+      return self.make('with_item', children)
+    keyword = self.expect('with')
+    parenthesized = self.peek() == '(' and \
+      self.tokens[self.match[self.index]+1][1] == ':'
+    if parenthesized and \
+       any(item.optional_vars is not None for item in node.items):
+      raise NotImplementedError(
+        'ast parser does not support parenthesized context managers with as')
+    if parenthesized and len(node.items) > 1:
+      ## parso parses parenthesized context managers as a tuple
+      items = [self.make('atom', [self.leaf(), self.make('testlist_comp',
+        self.commas(node.items, with_item)), self.expect(')')])]
+    else:
+      items = self.commas(node.items, with_item)
+    return self.make('with_stmt',
+      [keyword] + items + [self.expect(':'), self.suite(node.body)])
+
+  def async_stmt(self, node):
+    return self.make('async_stmt',
+      [self.expect('async'),
+       self.method('stmt', node, node.__class__.__name__[5:])(node)])
+  stmt_AsyncFor = stmt_AsyncWith = async_stmt
+
+  def decorator(self, node):
+    children = [self.expect('@')]
+    if self.version < (3, 9):
+      children.append(self.dotted_name())
+      if isinstance(node, ast.Call):
+        children.append(self.expect('('))
+        children.extend(self.arglist(node.args, node.keywords))
+        children.append(self.expect(')'))
+    else:
+      children.append(self.expr(node))
+    children.append(self.leaf())  # newline
+    return self.make('decorator', children)
+
+  def decorated(self, node, definition):
+    decorators = [self.decorator(decorator)
+                  for decorator in node.decorator_list]
+    is_async = isinstance(node, ast.AsyncFunctionDef)
+    if is_async:
+      keyword = self.expect('async')
+    result = definition()
+    if is_async:
+      result = self.make('async_funcdef' if decorators else 'async_stmt',
+        [keyword, result])
+    if decorators:
+      result = self.make('decorated',
+        [self.make('decorators', decorators), result])
+    return result
+
+  def stmt_FunctionDef(self, node):
+    def definition():
+      children = [self.expect('def'), self.leaf(), self.expect('(')]
+      params = self.params(node.args, ')', True)
+      if params:
+        children.append(self.make('typedargslist', params))
+      children.append(self.expect(')'))
+      children[2:] = [self.make('parameters', children[2:])]
+      if node.returns is not None:
+        children.extend([self.expect('->'), self.expr(node.returns)])
+      children.extend([self.expect(':'), self.suite(node.body)])
+      return self.make('funcdef', children)
+    return self.decorated(node, definition)
+  stmt_AsyncFunctionDef = stmt_FunctionDef
+
+  def stmt_ClassDef(self, node):
+    def definition():
+      children = [self.expect('class'), self.leaf()]
+      if self.peek() == '(':
+        children.append(self.leaf())
+        children.extend(self.arglist(node.bases, node.keywords))
+        children.append(self.expect(')'))
+      children.extend([self.expect(':'), self.suite(node.body)])
+      return self.make('classdef', children)
+    return self.decorated(node, definition)
+
+  def params(self, args, end, annotated):
+    ## Parameters in source order, with their annotations and defaults
+    positional = args.posonlyargs + args.args
+    defaults = [None] * (len(positional) - len(args.defaults)) + args.defaults
+    info = {}
+    for arg, default in zip(positional, defaults):
+      info[arg.arg] = arg, default
+    for arg, default in zip(args.kwonlyargs, args.kw_defaults):
+      info[arg.arg] = arg, default
+    for arg in [args.vararg, args.kwarg]:
+      if arg is not None:
+        info[arg.arg] = arg, None
+    children = []
+    while self.peek() != end:
+      if self.peek_type() != tokenize.NAME:  # , * ** /
+        children.append(self.leaf())
+        continue
+      name = self.leaf()
+      arg, default = info[name.value]
+      if annotated and arg.annotation is not None:
+        name = self.make('tfpdef',
+          [name, self.expect(':'), self.expr(arg.annotation)])
+      children.append(name)
+      if default is not None:
+        children.extend([self.expect('='), self.expr(default)])
+    return children
+
+  ## Expressions
+
+  def commas(self, items, build):
+    ## Build comma-separated items, including any trailing comma
+    children = []
+    for item in items:
+      if children:
+        children.append(self.expect(','))
+      children.append(build(item))
+    if children and self.peek() == ',':
+      children.append(self.leaf())
+    return children
+
+  def expr(self, node, kind = 'testlist_star_expr'):
+    ## kind is the node type for a tuple without parentheses
+    if self.peek() == '(' and self.peek_start() < self.start(node):
+      return self.make('atom',
+        [self.leaf(), self.expr(node, kind), self.expect(')')])
+    return self.method('expr', node)(node, kind)
+
+  def expr_Name(self, node, kind):
+    return self.leaf()
+
+  def expr_Constant(self, node, kind):
+    if self.peek_type() in [tokenize.STRING, FSTRING_START]:
+      return self.strings(node)
+    return self.leaf()
+
+  def expr_JoinedStr(self, node, kind):
+    return self.strings(node)
+
+  def strings(self, node):
+    end = self.end(node)
+    children = []
+    while self.peek_type() in [tokenize.STRING, FSTRING_START] and \
+          self.peek_start() < end:
+      children.append(self.leaf())
+    return self.make('strings', children)
+
+  def expr_Attribute(self, node, kind):
+    trailers = []
+    ## Flatten x.y(z)[w] into one atom_expr, unless parenthesized
+    while isinstance(node, (ast.Attribute, ast.Call, ast.Subscript)):
+      if isinstance(node, ast.Call):
+        inner = node.func
+      else:
+        inner = node.value
+      trailers.append(node)
+      if self.start(inner) != self.start(node):
+        node = inner
+        break
+      node = inner
+    children = []
+    if isinstance(node, ast.Await) and \
+       self.peek_start() == self.start(node):
+      children.append(self.expect('await'))
+      node = node.value
+      if isinstance(node, (ast.Attribute, ast.Call, ast.Subscript)) and \
+         self.peek_start() == self.start(node):
+        inner = self.expr_Attribute(node, kind)
+        if inner.type == 'atom_expr':
+          children.extend(inner.children)
+        else:
+          children.append(inner)
+        node = None
+    if node is not None:
+      children.append(self.expr(node))
+    for trailer in reversed(trailers):
+      if isinstance(trailer, ast.Attribute):
+        children.append(self.make('trailer', [self.expect('.'), self.leaf()]))
+      elif isinstance(trailer, ast.Call):
+        children.append(self.make('trailer', [self.expect('(')] +
+          self.arglist(trailer.args, trailer.keywords) + [self.expect(')')]))
+      else:
+        children.append(self.make('trailer', [self.expect('['),
+          self.subscript(trailer.slice), self.expect(']')]))
+    return self.make('atom_expr', children)
+  expr_Call = expr_Subscript = expr_Await = expr_Attribute
+
+  def arglist(self, args, keywords):
+    def argument(arg):
+      if isinstance(arg, ast.keyword):
+        if arg.arg is None:
+          return self.make('argument', [self.expect('**'), self.expr(arg.value)])
+        return self.make('argument',
+          [self.leaf(), self.expect('='), self.expr(arg.value)])
+      elif isinstance(arg, ast.Starred):
+        return self.make('argument', [self.expect('*'), self.expr(arg.value)])
+      elif isinstance(arg, ast.NamedExpr) and \
+           self.peek_start() == self.start(arg):
+        return self.make('argument', self.expr_NamedExpr(arg, None).children)
+      return self.expr(arg, 'argument')
+    children = self.commas(sorted(args + keywords, key=self.start), argument)
+    if children:
+      return [self.make('arglist', children)]
+    return []
+
+  def subscript(self, node):
+    if isinstance(node, ast.Slice):
+      children = []
+      if node.lower is not None:
+        children.append(self.expr(node.lower))
+      children.append(self.expect(':'))
+      if node.upper is not None:
+        children.append(self.expr(node.upper))
+      if self.peek() == ':':
+        sliceop = [self.leaf()]
+        if node.step is not None:
+          sliceop.append(self.expr(node.step))
+        children.append(self.make('sliceop', sliceop))
+      return self.make('subscript', children)
+    elif isinstance(node, ast.Tuple) and not self.own_parens(node):
+      return self.make('subscriptlist', self.commas(node.elts, self.subscript))
+    return self.expr(node)
+
+  def expr_BinOp(self, node, kind):
+    type = binop_types[node.op.__class__]
+    if type == 'power':
+      return self.make('power',
+        [self.expr(node.left), self.leaf(), self.expr(node.right)])
+    ## Flatten left-associative chains like a + b - c, unless parenthesized
+    chain = [node]
+    while isinstance(chain[-1].left, ast.BinOp) and \
+          binop_types[chain[-1].left.op.__class__] == type and \
+          self.start(chain[-1].left) == self.start(node):
+      chain.append(chain[-1].left)
+    children = [self.expr(chain[-1].left)]
+    for binop in reversed(chain):
+      children.extend([self.leaf(), self.expr(binop.right)])
+    return self.make(type, children)
+
+  def expr_UnaryOp(self, node, kind):
+    if isinstance(node.op, ast.Not):
+      type = 'not_test'
+    else:
+      type = 'factor'
+    return self.make(type, [self.leaf(), self.expr(node.operand)])
+
+  def expr_BoolOp(self, node, kind):
+    children = [self.expr(node.values[0])]
+    for value in node.values[1:]:
+      children.extend([self.leaf(), self.expr(value)])
+    if isinstance(node.op, ast.And):
+      return self.make('and_test', children)
+    else:
+      return self.make('or_test', children)
+
+  def expr_Compare(self, node, kind):
+    children = [self.expr(node.left)]
+    for op, comparator in zip(node.ops, node.comparators):
+      if isinstance(op, (ast.NotIn, ast.IsNot)):
+        children.append(self.make('comp_op', [self.leaf(), self.leaf()]))
+      else:
+        children.append(self.leaf())
+      children.append(self.expr(comparator))
+    return self.make('comparison', children)
+
+  def expr_IfExp(self, node, kind):
+    return self.make('test', [self.expr(node.body), self.expect('if'),
+      self.expr(node.test), self.expect('else'), self.expr(node.orelse)])
+
+  def expr_Lambda(self, node, kind):
+    children = [self.expect('lambda')]
+    params = self.params(node.args, ':', False)
+    if params:
+      children.append(self.make('varargslist', params))
+    children.extend([self.expect(':'), self.expr(node.body)])
+    return self.make('lambdef', children)
+
+  def expr_NamedExpr(self, node, kind):
+    return self.make('namedexpr_test',
+      [self.expr(node.target), self.expect(':='), self.expr(node.value)])
+
+  def expr_Starred(self, node, kind):
+    return self.make('star_expr', [self.expect('*'), self.expr(node.value)])
+
+  def expr_Yield(self, node, kind):
+    children = [self.expect('yield')]
+    if node.value is not None:
+      if self.version < (3, 8):
+        children.append(self.expr(node.value, 'testlist'))
+      else:
+        children.append(self.expr(node.value))
+    return self.make('yield_expr', children)
+
+  def expr_YieldFrom(self, node, kind):
+    return self.make('yield_expr', [self.expect('yield'),
+      self.make('yield_arg', [self.expect('from'), self.expr(node.value)])])
+
+  def expr_Tuple(self, node, kind):
+    if self.own_parens(node):
+      return self.make('atom', [self.leaf(),
+        self.make('testlist_comp', self.commas(node.elts, self.expr)),
+        self.expect(')')])
+    return self.make(kind, self.commas(node.elts, self.expr))
+
+  def expr_List(self, node, kind):
+    return self.make('atom', [self.expect('['),
+      self.make('testlist_comp', self.commas(node.elts, self.expr)),
+      self.expect(']')])
+
+  def expr_Set(self, node, kind):
+    return self.make('atom', [self.expect('{'),
+      self.make('dictorsetmaker', self.commas(node.elts, self.expr)),
+      self.expect('}')])
+
+  def expr_Dict(self, node, kind):
+    brace = self.expect('{')
+    children = []
+    for key, value in zip(node.keys, node.values):
+      if children:
+        children.append(self.expect(','))
+      if key is None:
+        children.extend([self.expect('**'), self.expr(value)])
+      else:
+        children.extend([self.expr(key), self.expect(':'), self.expr(value)])
+    if children and self.peek() == ',':
+      children.append(self.leaf())
+    return self.make('atom', [brace, self.make('dictorsetmaker', children),
+      self.expect('}')])
+
+  def expr_ListComp(self, node, kind):
+    return self.make('atom', [self.expect('['), self.make('testlist_comp',
+      [self.expr(node.elt), self.comp_for(node.generators)]),
+      self.expect(']')])
+
+  def expr_SetComp(self, node, kind):
+    return self.make('atom', [self.expect('{'), self.make('dictorsetmaker',
+      [self.expr(node.elt), self.comp_for(node.generators)]),
+      self.expect('}')])
+
+  def expr_DictComp(self, node, kind):
+    return self.make('atom', [self.expect('{'), self.make('dictorsetmaker',
+      [self.expr(node.key), self.expect(':'), self.expr(node.value),
+       self.comp_for(node.generators)]), self.expect('}')])
+
+  def expr_GeneratorExp(self, node, kind):
+    if self.own_parens(node):
+      return self.make('atom', [self.leaf(), self.make('testlist_comp',
+        [self.expr(node.elt), self.comp_for(node.generators)]),
+        self.expect(')')])
+    ## Sole argument to a function call
+    return self.make('argument',
+      [self.expr(node.elt), self.comp_for(node.generators)])
+
+  def comp_for(self, generators, index = 0, if_index = 0):
+    generator = generators[index]
+    if if_index == 0:
+      if generator.is_async:
+        keyword = self.expect('async')
+      children = [self.expect('for'), self.expr(generator.target, 'exprlist'),
+        self.expect('in'), self.expr(generator.iter)]
+    else:
+      children = [self.expect('if'), self.expr(generator.ifs[if_index-1])]
+    if if_index < len(generator.ifs):
+      children.append(self.comp_for(generators, index, if_index + 1))
+    elif index + 1 < len(generators):
+      children.append(self.comp_for(generators, index + 1))
+    if if_index:
+      return self.make('comp_if', children)
+    result = self.make('sync_comp_for', children)
+    if generator.is_async:
+      result = self.make('comp_for', [keyword, result])
+    return result
+
+def parse_ast(code, version):
+  try:
+    return AstTreeBuilder(code, version).build()
+  except NotImplementedError as e:
+    warn('%s; falling back to parso' % e)
+    return parse_parso(code, version)
+
+frontends = {
+  'parso': parse_parso,
+  'ast': parse_ast,
+}
 
 argparser = argparse.ArgumentParser(
   description="Attempt to convert Python code into CoffeeScript")
 argparser.add_argument('-p', '--python', metavar='N.N',
   dest='python_version', default='3.6', help='Python version (e.g. 2.7)')
+argparser.add_argument('--parser', choices=sorted(frontends),
+  default='parso', help='Python parser to use (default: parso); '
+  'ast is sometimes slightly faster but supports only Python 3 code, '
+  'in the running version')
+argparser.add_argument('--extend', choices=['spread', 'helper'],
+  default='spread', help='Convert .extend(x) into .push(...x) (default: '
+  'spread), or into a call to a helper that pushes in chunks, which works '
+  'for arrays too large to pass as arguments')
+argparser.add_argument('-r', '--range', metavar='L:C-L:C',
+  help='Convert only the statements enclosing this range of lines:columns '
+       '(lines 1-based, columns 0-based), printing to standard output')
+argparser.add_argument('-j', '--jobs', metavar='N', type=int,
+  help='Convert files in N parallel worker processes, largest files first')
+argparser.add_argument('-t', '--threads', metavar='N', type=int,
+  help='Convert files in N parallel threads (within one process)')
+argparser.add_argument('--timeout', metavar='SECONDS', type=float,
+  help='Skip files that take longer than this to convert (implies -j)')
+argparser.add_argument('--memory', metavar='MB', type=float,
+  help='Skip files that need more memory than this to convert (implies -j)')
 argparser.add_argument('filenames', metavar='filename.py', type=str,
   nargs='+', help='Python code to convert into filename.coffee')
 
+def parse_range(arg):
+  match = re.match(r'^(\d+)(?::(\d+))?(?:-(\d+)(?::(\d+))?)?$', arg)
+  if not match:
+    argparser.error('invalid range %r' % arg)
+  start_line = int(match.group(1))
+  start_column = int(match.group(2) or 0)
+  if match.group(3) is None:
+    return (start_line, start_column), (start_line, start_column)
+  return (start_line, start_column), \
+         (int(match.group(3)), int(match.group(4) or 0))
+
+def print_diagnostics(filename, conversion):
+  for message in conversion.diagnostics:
+    print('%s: %s' % (filename, message), file=sys.stderr)
+
+def main_range(args):
+  start, end = parse_range(args.range)
+  for filename in args.filenames:
+    with open(filename, 'r', encoding='utf8') as pyfile:
+      py = pyfile.read()
+    conversion = Conversion(extend=args.extend)
+    with converting(conversion):
+      if args.parser == 'parso':  # reuse parso's cache for repeated calls
+        tree = parse_parso(py, args.python_version, filename)
+      else:
+        tree = frontends[args.parser](py, args.python_version)
+      cs, region_start, region_end = \
+        convert_range(tree, start, end, conversion)
+    print_diagnostics(filename, conversion)
+    print('%s:%d:%d-%d:%d' % ((filename,) + region_start + region_end))
+    print(cs, end='')
+
+def convert_file(filename, args, dump = False):
+  with open(filename, 'r', encoding='utf8') as pyfile:
+    py = pyfile.read()
+    newline = pyfile.newlines
+  if isinstance(newline, tuple): newline = newline[0]
+  conversion = Conversion(extend=args.extend)
+  with converting(conversion):
+    tree = frontends[args.parser](py, args.python_version)
+    if dump:
+      dump_tree(tree)
+    csname = os.path.splitext(filename)[0] + '.coffee'
+    if dump:
+      print('==>', csname)
+    cs = convert_tree(tree, conversion)
+  print_diagnostics(filename, conversion)
+  with open(csname, 'w', newline=newline, encoding='utf8') as csfile:
+    csfile.write(cs)
+  return csname
+
+def schedule(filenames, problems):
+  ## Files to convert, largest first, so that the biggest conversions don't
+  ## end up running alone at the end.  Missing files get added to problems.
+  sizes = {}
+  for filename in filenames:
+    if filename.endswith('.coffee'): continue  ## avoid overwrite
+    try:
+      sizes[filename] = os.path.getsize(filename)
+    except OSError as e:
+      problems.append((filename, e.strerror))
+  return sorted(sizes, key=lambda filename: -sizes[filename])
+
+def report_problems(problems):
+  ## Returns the exit status: 1 if any files were skipped, else 0
+  if problems:
+    print('Skipped %d file(s):' % len(problems))
+    for filename, reason in problems:
+      print('  %s: %s' % (filename, reason))
+    return 1
+  return 0
+
+def main_threads(args):
+  '''Convert files concurrently in a pool of threads.
+
+  Unlike batch mode, this needs no worker processes, but cannot enforce
+  --timeout or --memory.  Files that fail get reported at the end.
+  '''
+  problems = []
+  pending = schedule(args.filenames, problems)
+  with concurrent.futures.ThreadPoolExecutor(args.threads) as pool:
+    futures = {pool.submit(convert_file, filename, args): filename
+               for filename in pending}
+    for future in concurrent.futures.as_completed(futures):
+      filename = futures[future]
+      try:
+        print(filename, '==>', future.result())
+      except Exception as e:
+        problems.append((filename, 'failed (%s: %s)' %
+          (e.__class__.__name__, e)))
+  return report_problems(problems)
+
+## Exit code of batch workers that run out of memory
+## (other errors print a traceback and exit with 1)
+WORKER_MEMORY = 2
+
+def batch_worker(filename, args):
+  if args.memory is not None:
+    limit = int(args.memory * 2**20)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+  try:
+    convert_file(filename, args)
+  except MemoryError:
+    sys.exit(WORKER_MEMORY)
+
+def main_batch(args):
+  '''Convert each file in its own worker process, with optional limits.
+
+  Files get scheduled largest first (see schedule).  Files that fail,
+  exceed --timeout, or exceed --memory get reported at the end instead of
+  stopping the batch.
+  '''
+  if args.memory is not None and resource is None:
+    warnings.warn('--memory is not supported on this platform')
+    args.memory = None
+  problems = []
+  pending = schedule(args.filenames, problems)
+  jobs = args.jobs or os.cpu_count() or 1
+  running = {}  # sentinel -> (process, filename, start time)
+  while pending or running:
+    while pending and len(running) < jobs:
+      filename = pending.pop(0)
+      process = multiprocessing.Process(target=batch_worker,
+        args=(filename, args))
+      process.start()
+      running[process.sentinel] = (process, filename, time.monotonic())
+    if args.timeout is None:
+      timeout = None
+    else:
+      timeout = max(0, min(start for process, filename, start in
+        running.values()) + args.timeout - time.monotonic())
+    multiprocessing.connection.wait(list(running), timeout)
+    now = time.monotonic()
+    for sentinel, (process, filename, start) in list(running.items()):
+      if process.exitcode is None:
+        if args.timeout is None or now - start < args.timeout:
+          continue
+        process.kill()
+        process.join()
+        problems.append((filename, 'timed out after %gs' % args.timeout))
+      elif process.exitcode == 0:
+        print(filename, '==>', os.path.splitext(filename)[0] + '.coffee')
+      elif process.exitcode == WORKER_MEMORY:
+        problems.append((filename, 'out of memory (limit %gMB)' % args.memory))
+      else:
+        problems.append((filename, 'failed (exit code %d)' % process.exitcode))
+      del running[sentinel]
+  return report_problems(problems)
+
 def main():
   args = argparser.parse_args()
+  if args.range is not None:
+    return main_range(args)
+  if args.threads is not None:
+    if args.jobs is not None or args.timeout is not None or \
+       args.memory is not None:
+      argparser.error('--threads cannot be combined with -j, --timeout, '
+                      'or --memory')
+    return main_threads(args)
+  if args.jobs is not None or args.timeout is not None or \
+     args.memory is not None:
+    return main_batch(args)
   for filename in args.filenames:
     print(filename)
     if filename.endswith('.coffee'): continue  ## avoid overwrite
-    with open(filename, 'r', encoding='utf8') as pyfile:
-      py = pyfile.read()
-      newline = pyfile.newlines
-    if isinstance(newline, tuple): newline = newline[0]
-    tree = parso.parse(py, version=args.python_version)
-    dump_tree(tree)
-    csname = os.path.splitext(filename)[0] + '.coffee'
-    print('==>', csname)
-    cs = convert_tree(tree)
-    with open(csname, 'w', newline=newline, encoding='utf8') as csfile:
-      csfile.write(cs)
+    convert_file(filename, args, dump=True)
 
-if __name__ == '__main__': main()
+if __name__ == '__main__': sys.exit(main())
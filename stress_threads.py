@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+'''Check that converting files concurrently in threads matches serial runs.
+
+Converts each file (with each --extend mode) serially, then several times
+in a pool of threads (in reverse order, to mix up which conversions
+overlap), and reports any conversions whose CoffeeScript or diagnostics
+differ.  Exits with status 1 if there are any.
+'''
+import argparse, concurrent.futures, glob, os, sys, sysconfig, time
+import python2coffee
+
+def job(args):
+  filename, extend, version, parser = args
+  conversion = python2coffee.Conversion(extend=extend)
+  with open(filename, encoding='utf8') as file:
+    code = file.read()
+  try:
+    coffee = python2coffee.convert_code(code, version, parser, conversion)
+  except Exception as e:
+    coffee = 'Exception: %r' % e
+  return coffee, conversion.diagnostics
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('filenames', metavar='filename.py', nargs='*',
+    help='Python files to convert (default: the standard library modules)')
+  parser.add_argument('-t', '--threads', type=int, default=16,
+    help='number of threads (default: 16)')
+  parser.add_argument('-n', '--rounds', type=int, default=2,
+    help='number of threaded runs (default: 2)')
+  parser.add_argument('-p', '--python', metavar='N.N',
+    dest='python_version', default='3.8', help='Python version (e.g. 3.8)')
+  parser.add_argument('--parser', choices=sorted(python2coffee.frontends),
+    default='parso', help='Python parser to use (default: parso)')
+  args = parser.parse_args()
+  filenames = args.filenames or \
+    sorted(glob.glob(os.path.join(sysconfig.get_paths()['stdlib'], '*.py')))
+  sys.setrecursionlimit(20000)  # for deeply nested code
+  jobs = [(filename, extend, args.python_version, args.parser)
+          for filename in filenames for extend in ['spread', 'helper']]
+
+  start = time.time()
+  serial = list(map(job, jobs))
+  print('serial: %d conversions in %.1fs' % (len(jobs), time.time() - start))
+  mismatches = 0
+  for round in range(args.rounds):
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(args.threads) as pool:
+      threaded = list(pool.map(job, jobs[::-1]))[::-1]
+    print('%d threads: %d conversions in %.1fs' %
+      (args.threads, len(jobs), time.time() - start))
+    for (filename, extend, _, _), a, b in zip(jobs, serial, threaded):
+      if a != b:
+        mismatches += 1
+        print('MISMATCH: %s (--extend %s)' % (filename, extend))
+  print('%d mismatches' % mismatches)
+  sys.exit(1 if mismatches else 0)
+
+if __name__ == '__main__': main()